@@ -1,5 +1,9 @@
+import tensorflow as tf
 from tensorflow.keras import backend as K
-K.set_floatx('float64')
+
+# The layers and model are compiled with tf.function(jit_compile = True), which was added in TensorFlow 2.5
+if tuple(int(v) for v in tf.__version__.split('.')[:2]) < (2, 5):
+    raise ImportError(f"qpga requires TensorFlow 2.5 or later, but TensorFlow {tf.__version__} is installed")
 
 # from qpga.constants import *
 # from qpga.linalg import *
@@ -7,4 +11,7 @@ K.set_floatx('float64')
 from qpga.model import *
 # from qpga.plotting import *
 # from qpga.state_preparation import *
-# from qpga.fidelity_search import *
\ No newline at end of file
+# from qpga.fidelity_search import *
+
+# Keras' default float type matches the default model precision, so Keras layers don't cast real inputs back and forth
+K.set_floatx(DTYPE_R.name)
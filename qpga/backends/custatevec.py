@@ -0,0 +1,95 @@
+import numpy as np
+import tensorflow as tf
+
+try:
+    import cupy as cp
+    from cuquantum import custatevec as cusv
+    from cuquantum import cudaDataType, ComputeType
+except ImportError:
+    cp = None
+    cusv = None
+
+_handle = None
+
+
+def is_available():
+    '''Checks whether cuStateVec can be used, which requires cuquantum, cupy, and a GPU visible to TensorFlow'''
+    return cusv is not None and len(tf.config.list_physical_devices('GPU')) > 0
+
+
+def get_handle():
+    '''Returns a cuStateVec handle, which is created once and shared by all calls'''
+    global _handle
+    if _handle is None:
+        _handle = cusv.create()
+    return _handle
+
+
+def get_cuda_types(dtype):
+    '''Returns the cuStateVec (data type, compute type) for a numpy complex dtype'''
+    if np.dtype(dtype) == np.complex64:
+        return cudaDataType.CUDA_C_32F, ComputeType.COMPUTE_32F
+    elif np.dtype(dtype) == np.complex128:
+        return cudaDataType.CUDA_C_64F, ComputeType.COMPUTE_64F
+    else:
+        raise ValueError(f"Unsupported dtype for cuStateVec: {dtype}")
+
+
+def apply_single_qubit_layer(sv, unitaries):
+    '''
+    Applies a single qubit layer in place to a batch of states on the GPU with custatevecApplyMatrix
+
+    :param cp.ndarray sv: C-contiguous [batch, 2^N] complex states
+    :param np.ndarray unitaries: [N, 2, 2] operators applied to each qubit (see qpga.model.single_qubit_unitaries)
+    :return: cp.ndarray of the output states, which is sv itself
+    '''
+    batch_size, dim = sv.shape
+    num_qubits = unitaries.shape[0]
+    data_type, compute_type = get_cuda_types(sv.dtype)
+    handle = get_handle()
+
+    ops = np.ascontiguousarray(unitaries, dtype = sv.dtype)
+
+    # The batch is contiguous, so a run of 2^j states is a single state vector with j extra high index bits, and acting
+    # on its low N bits applies an operator to every state of the run. A batch then takes one call per qubit for each
+    # set bit of its size rather than one per state.
+    start = 0
+    for j in reversed(range(batch_size.bit_length())):
+        if not (batch_size >> j) & 1:
+            continue
+        ptr = sv.data.ptr + start * dim * sv.itemsize
+        for k in range(num_qubits):
+            # cuStateVec indexes qubits from the least significant bit and acts on column vectors, whereas qubit 0 is
+            # the most significant bit here and states are row vectors, so each row-major operator is read as
+            # column-major to apply its transpose
+            cusv.apply_matrix(handle, ptr, data_type, num_qubits + j,
+                              ops[k].ctypes.data, data_type, cusv.MatrixLayout.COL, 0,
+                              [num_qubits - 1 - k], 1, 0, 0, 0,
+                              compute_type, 0, 0)
+        start += 1 << j
+
+    return sv
+
+
+def tf_apply_single_qubit_layer(x, unitaries):
+    '''
+    Wraps apply_single_qubit_layer as a TensorFlow op for a flat or tensorized batch of states on the GPU. The states
+    are exchanged with CuPy through DLPack, so they stay on the device. No gradients flow through this op, so it is only
+    suitable for inference.
+    '''
+
+    def apply(x_tensor, unitaries_tensor):
+        shape = x_tensor.shape
+        x_dlpack = tf.experimental.dlpack.to_dlpack(x_tensor)
+        # TensorFlow and CuPy run on different streams, so wait for the input before reading it and for the output
+        # before handing it back
+        cp.cuda.Device().synchronize()
+        # TensorFlow tensors are immutable, so the layer is applied to a device-side copy
+        sv = cp.from_dlpack(x_dlpack).reshape(shape[0], -1).copy()
+        apply_single_qubit_layer(sv, unitaries_tensor.numpy())
+        cp.cuda.Device().synchronize()
+        return tf.experimental.dlpack.from_dlpack(sv.reshape(shape).toDlpack())
+
+    out = tf.py_function(apply, [tf.stop_gradient(x), tf.stop_gradient(unitaries)], Tout = x.dtype)
+    out.set_shape(x.shape)
+    return out
@@ -0,0 +1,114 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from qpga.constants import BS_MATRIX
+from qpga.linalg import cphase_transfer_diag
+from qpga.model import SingleQubitOperationLayer, CPhaseLayer
+
+# Precision follows the weights and states passed in. JAX truncates to single precision unless the caller opts in
+# with jax.config.update("jax_enable_x64", True), which is needed to reproduce a complex128 model. The beamsplitter is
+# kept as a numpy array and converted to the dtype of the state when applied, so enabling x64 after import still gives
+# it full precision.
+BS = BS_MATRIX
+
+
+def phase_shift_diag(phi_0, phi_1):
+    '''Returns the diagonal of the tensor product of single-qubit phase shifts diag(e^(i phi_0[k]), e^(i phi_1[k]))'''
+    single_qubit_diags = jnp.stack([jnp.exp(1j * phi_0), jnp.exp(1j * phi_1)], axis = -1)
+    diag = single_qubit_diags[0]
+    for single_qubit_diag in single_qubit_diags[1:]:
+        diag = jnp.reshape(diag[:, None] * single_qubit_diag[None, :], [-1])
+    return diag
+
+
+def apply_bs(state, bs):
+    '''Applies bs to each qubit of a single 2^N state vector as N mode-wise 2x2 contractions'''
+    num_qubits = int(np.log2(state.shape[-1]))
+    out = jnp.reshape(state, [2] * num_qubits)
+    bs = jnp.asarray(bs, dtype = state.dtype)
+    for k in range(num_qubits):
+        out = jnp.moveaxis(jnp.tensordot(out, bs, axes = [[k], [0]]), -1, k)
+    return jnp.reshape(out, [-1])
+
+
+def apply_single(state, alphas, betas, thetas, phis, bs = BS):
+    '''Pure-function equivalent of SingleQubitOperationLayer.call for a single state vector'''
+    out = state * phase_shift_diag(alphas, betas)
+    out = apply_bs(out, bs)
+    out = out * phase_shift_diag(thetas, jnp.zeros_like(thetas))
+    out = apply_bs(out, bs)
+    out = out * phase_shift_diag(phis, jnp.zeros_like(phis))
+    return out
+
+
+def apply_cphase(state, transfer_diag):
+    '''Pure-function equivalent of CPhaseLayer.call for a single state vector'''
+    return state * transfer_diag
+
+
+def qpga_apply(state, params_list, cphase_diags):
+    '''
+    Applies the QPGA to a single state vector
+
+    :param state: complex state vector of length 2^N
+    :param params_list: list of (alphas, betas, thetas, phis) tuples, one per single qubit layer, including the input
+        layer
+    :param cphase_diags: list of CPHASE layer diagonals, one per single qubit layer after the input layer
+    :return: the output state vector
+    '''
+    out = apply_single(state, *params_list[0])
+    for params, transfer_diag in zip(params_list[1:], cphase_diags):
+        out = apply_cphase(out, transfer_diag)
+        out = apply_single(out, *params)
+    return out
+
+
+qpga_apply_batch = jax.jit(jax.vmap(qpga_apply, in_axes = (0, None, None)))
+
+
+def antifidelity(params_list, cphase_diags, states_in, states_out):
+    '''Mean antifidelity 1 - |<out|QPGA|in>|^2 over a batch of complex input and target states'''
+    states_pred = jax.vmap(qpga_apply, in_axes = (0, None, None))(states_in, params_list, cphase_diags)
+    inner_prods = jnp.sum(jnp.conj(states_out) * states_pred, axis = -1)
+    return jnp.mean(1 - jnp.abs(inner_prods) ** 2)
+
+
+antifidelity_and_grad = jax.jit(jax.value_and_grad(antifidelity))
+
+
+def init_params(num_qubits, depth, seed = 0):
+    '''Randomly initializes QPGA parameters the same way as SingleQubitOperationLayer'''
+    keys = jax.random.split(jax.random.PRNGKey(seed), depth + 1)
+    params_list = [tuple(jax.random.uniform(key, (4, num_qubits), minval = 0, maxval = 2 * np.pi)) for key in keys]
+    return params_list
+
+
+def get_cphase_diags(num_qubits, depth, use_standard_cphase = True):
+    '''Returns the CPHASE layer diagonals for a QPGA of the given depth'''
+    return [jnp.asarray(cphase_transfer_diag(num_qubits, parity = i % 2, use_standard_cphase = use_standard_cphase))
+            for i in range(depth)]
+
+
+def params_from_keras(model):
+    '''
+    Reads the parameters out of a QPGA model (or its sequential version) for use with qpga_apply
+
+    :return: (params_list, cphase_diags)
+    '''
+    params_list = []
+    cphase_diags = []
+    for layer in model.layers:
+        if isinstance(layer, SingleQubitOperationLayer):
+            params_list.append(tuple(jnp.asarray(w) for w in layer.get_weights()))
+        elif isinstance(layer, CPhaseLayer):
+            cphase_diags.append(jnp.asarray(layer.transfer_diag_np))
+    return params_list, cphase_diags
+
+
+def params_to_keras(model, params_list):
+    '''Writes parameters from qpga_apply back into a built QPGA model (or its sequential version)'''
+    single_qubit_layers = [layer for layer in model.layers if isinstance(layer, SingleQubitOperationLayer)]
+    assert len(single_qubit_layers) == len(params_list)
+    for layer, params in zip(single_qubit_layers, params_list):
+        layer.set_weights([np.asarray(p) for p in params])
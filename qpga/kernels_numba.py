@@ -0,0 +1,135 @@
+import numpy as np
+from numba import njit, prange
+
+from qpga.constants import BS_MATRIX
+from qpga.linalg import cphase_transfer_diag
+from qpga.model import SingleQubitOperationLayer, CPhaseLayer
+from qpga.utils import np_to_complex, np_to_k_complex
+
+
+@njit(cache = True, fastmath = True)
+def single_qubit_unitaries(alphas, betas, thetas, phis, bs):
+    '''Returns the [N, 2, 2] stack of operators that a SingleQubitOperationLayer applies to each qubit'''
+    num_qubits = alphas.shape[0]
+    unitaries = np.empty((num_qubits, 2, 2), dtype = np.complex128)
+    for k in range(num_qubits):
+        input_shifts = (np.exp(1j * alphas[k]), np.exp(1j * betas[k]))
+        theta_shifts = (np.exp(1j * thetas[k]), 1.0 + 0j)
+        phi_shifts = (np.exp(1j * phis[k]), 1.0 + 0j)
+        for i in range(2):
+            for l in range(2):
+                total = 0j
+                for j in range(2):
+                    total += input_shifts[i] * bs[i, j] * theta_shifts[j] * bs[j, l]
+                unitaries[k, i, l] = total * phi_shifts[l]
+    return unitaries
+
+
+@njit(cache = True, fastmath = True)
+def apply_single_qubit_op(psi, op, stride):
+    '''Applies the 2x2 operator op in place to the qubit of the flat state psi whose amplitudes are stride apart'''
+    for block in range(0, psi.shape[0], 2 * stride):
+        for i in range(block, block + stride):
+            a = psi[i]
+            b = psi[i + stride]
+            # States are row vectors, so the output is psi @ op
+            psi[i] = a * op[0, 0] + b * op[1, 0]
+            psi[i + stride] = a * op[0, 1] + b * op[1, 1]
+
+
+@njit(parallel = True, cache = True, fastmath = True)
+def apply_bs_all_qubits(state_flat, bs):
+    '''
+    Applies the same 2x2 operator bs (e.g. BS_MATRIX) in place to every qubit of a flat 2^N state. The operators on
+    different qubits commute, so the qubits are swept in order of increasing stride.
+    '''
+    b00, b01, b10, b11 = bs[0, 0], bs[0, 1], bs[1, 0], bs[1, 1]
+    num_pairs = state_flat.shape[0] // 2
+    stride = 1
+    while stride < state_flat.shape[0]:
+        # Parallelize over amplitude pairs rather than blocks so every stride has enough work to split
+        for p in prange(num_pairs):
+            i = (p // stride) * 2 * stride + p % stride
+            a = state_flat[i]
+            b = state_flat[i + stride]
+            state_flat[i] = a * b00 + b * b10
+            state_flat[i + stride] = a * b01 + b * b11
+        stride *= 2
+    return state_flat
+
+
+@njit(parallel = True, cache = True, fastmath = True)
+def apply_single_qubit_layer(state, alphas, betas, thetas, phis, bs):
+    '''
+    Applies a SingleQubitOperationLayer in place to a [batch, 2^N] complex state. Qubit 0 is the most significant
+    bit of the state index, matching the Kronecker product ordering of the TensorFlow model.
+    '''
+    num_qubits = alphas.shape[0]
+    unitaries = single_qubit_unitaries(alphas, betas, thetas, phis, bs)
+    for b in prange(state.shape[0]):
+        for k in range(num_qubits):
+            apply_single_qubit_op(state[b], unitaries[k], 1 << (num_qubits - 1 - k))
+    return state
+
+
+@njit(parallel = True, cache = True, fastmath = True)
+def apply_cphase_diag(state, diag):
+    '''Applies a CPhaseLayer in place to a [batch, 2^N] complex state given its transfer matrix diagonal'''
+    for b in prange(state.shape[0]):
+        for i in range(state.shape[1]):
+            state[b, i] *= diag[i]
+    return state
+
+
+class NumbaQPGA:
+    '''Inference-only CPU implementation of a QPGA using Numba kernels'''
+
+    def __init__(self, num_qubits, depth,
+                 complex_inputs = False,
+                 complex_outputs = False,
+                 use_standard_cphase = True):
+        self.num_qubits = num_qubits
+        self.input_dim = 2 ** num_qubits
+
+        self.depth = depth
+        self.complex_inputs = complex_inputs
+        self.complex_outputs = complex_outputs
+        self.use_standard_cphase = use_standard_cphase
+
+        # One (alphas, betas, thetas, phis) tuple per single qubit layer, including the input layer
+        self.params_list = [tuple(np.random.uniform(0, 2 * np.pi, size = (4, num_qubits))) for _ in range(depth + 1)]
+        self.cphase_diags = [cphase_transfer_diag(num_qubits, parity = i % 2, use_standard_cphase = use_standard_cphase)
+                             for i in range(depth)]
+        self.bs = np.array(BS_MATRIX, dtype = np.complex128)
+
+    @classmethod
+    def from_keras(cls, model):
+        '''Creates a NumbaQPGA with the weights of a trained QPGA model (or its sequential version)'''
+        single_qubit_layers = [layer for layer in model.layers if isinstance(layer, SingleQubitOperationLayer)]
+        cphase_layers = [layer for layer in model.layers if isinstance(layer, CPhaseLayer)]
+
+        qpga = cls(model.num_qubits, len(cphase_layers),
+                   complex_inputs = model.complex_inputs,
+                   complex_outputs = model.complex_outputs,
+                   use_standard_cphase = cphase_layers[0].use_standard_cphase if cphase_layers else True)
+        qpga.params_list = [tuple(np.asarray(w, dtype = np.float64) for w in layer.get_weights())
+                            for layer in single_qubit_layers]
+        qpga.cphase_diags = [np.asarray(layer.transfer_diag_np, dtype = np.complex128) for layer in cphase_layers]
+        return qpga
+
+    def predict(self, inputs):
+        '''Applies the QPGA to a batch of input states'''
+        if not self.complex_inputs:
+            state = np_to_complex(inputs)
+        else:
+            state = np.array(inputs, dtype = np.complex128)
+
+        state = apply_single_qubit_layer(state, *self.params_list[0], self.bs)
+        for params, cphase_diag in zip(self.params_list[1:], self.cphase_diags):
+            state = apply_cphase_diag(state, cphase_diag)
+            state = apply_single_qubit_layer(state, *params, self.bs)
+
+        if not self.complex_outputs:
+            state = np_to_k_complex(state)
+
+        return state
@@ -1,6 +1,7 @@
 import numpy as np
 import squanch
 
+from qpga.constants import IDENTITY, CPHASE, CPHASE_MOD
 from qpga.utils import np_to_k_complex, k_to_np_complex
 
 
@@ -33,6 +34,36 @@ def tensors(operator_list):
     return result
 
 
+def cphase_transfer_diag(num_qubits, parity = 0, use_standard_cphase = False):
+    '''
+    Returns the diagonal of the operator applied by a layer of nearest-neighbor CPHASE gates. Every block is
+    diagonal, so this is the Kronecker product of the block diagonals.
+
+    :param int num_qubits: number of qubits
+    :param int parity: 0 to pair qubits (0, 1), (2, 3), ...; 1 to pair qubits (1, 2), (3, 4), ...
+    :param bool use_standard_cphase: use CPHASE instead of CPHASE_MOD
+    :return: np.ndarray of length 2^num_qubits
+    '''
+    cphase_gate = CPHASE if use_standard_cphase else CPHASE_MOD
+
+    ops = []
+    if parity == 0:
+        num_cphase = num_qubits // 2
+        for _ in range(num_cphase):
+            ops.append(cphase_gate)
+        if 2 * num_cphase < num_qubits:
+            ops.append(IDENTITY)
+    else:
+        ops.append(IDENTITY)
+        num_cphase = (num_qubits - 1) // 2
+        for _ in range(num_cphase):
+            ops.append(cphase_gate)
+        if 2 * num_cphase + 1 < num_qubits:
+            ops.append(IDENTITY)
+
+    return tensors([np.diag(op) for op in ops])
+
+
 def extract_operator_from_model(model, num_qubits=None):
     '''
     Reduces the action of the model to a complex-valued matrix
@@ -1,100 +1,261 @@
+import string
+
 import numpy as np
 import tensorflow as tf
 from tensorflow.python import keras
 from tensorflow.python.keras import Sequential, Input
-from tensorflow.python.keras.backend import dot
 from tensorflow.python.keras.layers import Layer, Lambda
 
 
 
+from qpga.backends import custatevec
 from qpga.utils import tf_to_k_complex, k_to_tf_complex
-from qpga.constants import IDENTITY, CPHASE_MOD, BS_MATRIX, CPHASE
-from qpga.linalg import tensors
-
-
-def phase_shifts_to_tensor_product_space(phi_0, phi_1):
-    phi_0_complex = tf.complex(tf.cos(phi_0), tf.sin(phi_0))
-    phi_1_complex = tf.complex(tf.cos(phi_1), tf.sin(phi_1))
-
-    single_qubit_ops = tf.unstack(
-            tf.map_fn(lambda U: tf.linalg.tensor_diag(U), tf.transpose([phi_0_complex, phi_1_complex])))
-
-    return tf.linalg.LinearOperatorKronecker([tf.linalg.LinearOperatorFullMatrix(U) for U in single_qubit_ops])
+from qpga.constants import CPHASE_MOD, BS_MATRIX, CPHASE
+from qpga.linalg import cphase_transfer_diag, tensors
+
+# Default dtypes of the layer weights and state vectors; single precision is sufficient for training a QPGA
+DTYPE_R = tf.float32
+DTYPE_C = tf.complex64
+
+
+def single_qubit_phase_shifts(phi_0, phi_1):
+    '''Returns an [N, 2] tensor whose row k holds the diagonal (e^(i phi_0[k]), e^(i phi_1[k])) of qubit k's shift'''
+    phi_0_complex = tf.exp(tf.complex(tf.zeros_like(phi_0), phi_0))
+    phi_1_complex = tf.exp(tf.complex(tf.zeros_like(phi_1), phi_1))
+    return tf.stack([phi_0_complex, phi_1_complex], axis = -1)
+
+
+def single_qubit_unitaries(alphas, betas, thetas, phis, bs):
+    '''
+    Returns the [N, 2, 2] stack of operators that a SingleQubitOperationLayer applies to each qubit. Every stage of the
+    layer is a tensor product over qubits, so the whole layer is the tensor product of these 2x2 operators.
+    '''
+    input_shifts = single_qubit_phase_shifts(alphas, betas)
+    theta_shifts = single_qubit_phase_shifts(thetas, tf.zeros_like(thetas))
+    phi_shifts = single_qubit_phase_shifts(phis, tf.zeros_like(phis))
+
+    # States are row vectors, so diagonal shifts scale rows when applied before a matrix and columns after it
+    ops = input_shifts[:, :, None] * bs[None, :, :] * theta_shifts[:, None, :]
+    ops = tf.einsum('kij,jl->kil', ops, bs) * phi_shifts[:, None, :]
+    return ops
+
+
+def mode_wise_einsum_equation(num_qubits):
+    '''
+    Returns the einsum equation which applies one 2x2 operator to each axis of a [batch, 2, ..., 2] state, e.g.
+    '...abc,aA,bB,cC->...ABC' for 3 qubits
+    '''
+    assert num_qubits <= len(string.ascii_lowercase)
+    in_axes = string.ascii_lowercase[:num_qubits]
+    out_axes = string.ascii_uppercase[:num_qubits]
+    ops = ','.join(i + o for i, o in zip(in_axes, out_axes))
+    return f'...{in_axes},{ops}->...{out_axes}'
+
+
+def real_mode_wise_einsum_equation(num_qubits):
+    '''
+    Returns the einsum equation which applies one real block operator (see real_block_operators) to each qubit of a
+    [batch, 2, 2, ..., 2] state holding its real and imaginary parts on axis 1. The real/imaginary index is chained
+    through the operators, e.g. '...dabc,daeA,ebfB,fcgC->...gABC' for 3 qubits
+    '''
+    in_axes = string.ascii_lowercase[:num_qubits]
+    out_axes = string.ascii_uppercase[:num_qubits]
+    parts = (string.ascii_lowercase[num_qubits:] + string.ascii_uppercase[num_qubits:])[:num_qubits + 1]
+    assert len(parts) == num_qubits + 1, "Too many qubits to label with einsum; use contraction = 'matmul' instead"
+    ops = ','.join(parts[k] + in_axes[k] + parts[k + 1] + out_axes[k] for k in range(num_qubits))
+    return f'...{parts[0]}{in_axes},{ops}->...{parts[-1]}{out_axes}'
+
+
+def real_block_operators(ops):
+    '''
+    Returns the real [N, 2, 2, 2, 2] operators equivalent to complex [N, 2, 2] operators on states whose real and
+    imaginary parts are stacked on an extra axis. Element [k, c, i, d, j] maps part c of amplitude i to part d of
+    amplitude j, so for row vectors each operator is the block matrix [[op_r, op_i], [-op_i, op_r]].
+    '''
+    ops_r, ops_i = tf.math.real(ops), tf.math.imag(ops)
+    return tf.stack([tf.stack([ops_r, ops_i], axis = 2), tf.stack([-ops_i, ops_r], axis = 2)], axis = 1)
+
+
+def get_state_shape(num_qubits, tensorized = False):
+    '''Returns the shape of a single (unbatched) state vector, either flat or with one axis per qubit'''
+    return [2] * num_qubits if tensorized else [2 ** num_qubits]
+
+
+def apply_single_qubit_op_matmul(x, op, q, num_qubits):
+    '''
+    Applies a 2x2 operator to qubit q of a [batch, 2, ..., 2] state as a single [*, 2] x [2, 2] matmul, which maps
+    onto a single GEMM on GPU, as an alternative to a single mode einsum
+
+    :param x: tensorized state
+    :param op: 2x2 operator
+    :param q: index of the qubit to apply op to
+    :param num_qubits: number of qubits of the state
+    :return: the tensorized output state
+    '''
+    # Axes before qubit q are grouped with the batch as hi, axes after it as lo
+    hi, lo = 2 ** q, 2 ** (num_qubits - q - 1)
+    x = tf.transpose(tf.reshape(x, [-1, hi, 2, lo]), [0, 1, 3, 2])
+    x = tf.matmul(tf.reshape(x, [-1, 2]), op)
+    x = tf.transpose(tf.reshape(x, [-1, hi, lo, 2]), [0, 1, 3, 2])
+    return tf.reshape(x, [-1] + get_state_shape(num_qubits, tensorized = True))
+
+
+def apply_single_qubit_ops_matmul(x, ops):
+    '''
+    Applies one 2x2 operator per qubit to a [batch, 2, ..., 2] state with one matmul per qubit, as an alternative to
+    the mode-wise einsum
+
+    :param x: tensorized state
+    :param ops: list of N 2x2 operators
+    :return: the tensorized output state
+    '''
+    for q, op in enumerate(ops):
+        x = apply_single_qubit_op_matmul(x, op, q, len(ops))
+    return x
+
+
+def apply_real_single_qubit_op_matmul(x, op, q, num_qubits):
+    '''
+    Applies a real block operator to qubit q of a [batch, 2, 2, ..., 2] state holding its real and imaginary parts on
+    axis 1, as a single [*, 4] x [4, 4] matmul
+
+    :param x: tensorized state with stacked real and imaginary parts
+    :param op: [2, 2, 2, 2] real block operator (see real_block_operators)
+    :param q: index of the qubit to apply op to
+    :param num_qubits: number of qubits of the state
+    :return: the tensorized output state with stacked real and imaginary parts
+    '''
+    # Axes before qubit q are grouped with the batch as hi, axes after it as lo
+    hi, lo = 2 ** q, 2 ** (num_qubits - q - 1)
+    x = tf.transpose(tf.reshape(x, [-1, 2, hi, 2, lo]), [0, 2, 4, 1, 3])
+    x = tf.matmul(tf.reshape(x, [-1, 4]), tf.reshape(op, [4, 4]))
+    x = tf.transpose(tf.reshape(x, [-1, hi, lo, 2, 2]), [0, 3, 1, 4, 2])
+    return tf.reshape(x, [-1, 2] + get_state_shape(num_qubits, tensorized = True))
+
+
+def cphase_transfer_diag_tensor(num_qubits, parity = 0, use_standard_cphase = False, complex_dtype = DTYPE_C,
+                                tensorized = False):
+    '''Returns the CPHASE layer diagonal as a constant shaped like a single state, so it broadcasts over the batch'''
+    transfer_diag = cphase_transfer_diag(num_qubits, parity = parity, use_standard_cphase = use_standard_cphase)
+    return tf.constant(np.reshape(transfer_diag, get_state_shape(num_qubits, tensorized)), dtype = complex_dtype)
 
 
 class SingleQubitOperationLayer(Layer):
 
-    def __init__(self, num_qubits, **kwargs):
+    def __init__(self, num_qubits, complex_dtype = DTYPE_C, tensorized = False, use_custatevec = False,
+                 contraction = 'einsum', **kwargs):
         self.num_qubits = num_qubits
         self.output_dim = 2 ** num_qubits
+        self.complex_dtype = tf.as_dtype(complex_dtype)
+        self.real_dtype = self.complex_dtype.real_dtype
+        # If tensorized, inputs and outputs have shape [batch, 2, ..., 2] rather than [batch, 2^N]
+        self.tensorized = tensorized
+        # Inference-only GPU path; falls back to the TensorFlow implementation if cuStateVec is unavailable
+        self.use_custatevec = use_custatevec and custatevec.is_available()
+        # How the per-qubit operators are applied: 'einsum' (one mode-wise einsum) or 'matmul' (one GEMM per qubit).
+        # Which is faster depends on the device, so this should be chosen by measurement.
+        assert contraction in ('einsum', 'matmul')
+        self.contraction = contraction
         super(SingleQubitOperationLayer, self).__init__(**kwargs)
 
+        # Compiling with XLA fuses the mode-wise contractions into a few kernels. The static input signature avoids
+        # retracing and lets XLA specialize to the state shape.
+        state_shape = get_state_shape(self.num_qubits, self.tensorized)
+        input_signature = [tf.TensorSpec([None] + state_shape, self.complex_dtype)]
+        self._call_fn = tf.function(self.apply_unitaries, input_signature = input_signature, jit_compile = True)
+
     def get_config(self):
         config = super(SingleQubitOperationLayer, self).get_config()
         config.update({
-            'num_qubits': self.num_qubits,
+            'num_qubits'    : self.num_qubits,
             # 'output_dim': self.output_dim
+            'complex_dtype' : self.complex_dtype.name,
+            'tensorized'    : self.tensorized,
+            'use_custatevec': self.use_custatevec,
+            'contraction'   : self.contraction,
         })
         return config
 
     def build(self, input_shape):
-        input_dim = input_shape[-1]
-        assert input_dim == self.output_dim
+        assert tf.TensorShape(input_shape).as_list()[1:] == get_state_shape(self.num_qubits, self.tensorized)
 
         initializer = tf.random_uniform_initializer(minval = 0, maxval = 2 * np.pi)
 
         # Create a trainable weight variable for this layer.
         self.alphas = self.add_weight(name = 'alphas',
-                                      dtype = tf.float64,
+                                      dtype = self.real_dtype,
                                       shape = (self.num_qubits,),
                                       trainable = True,
                                       initializer = initializer)
         self.betas = self.add_weight(name = 'betas',
-                                     dtype = tf.float64,
+                                     dtype = self.real_dtype,
                                      shape = (self.num_qubits,),
                                      trainable = True,
                                      initializer = initializer)
         self.thetas = self.add_weight(name = 'thetas',
-                                      dtype = tf.float64,
+                                      dtype = self.real_dtype,
                                       shape = (self.num_qubits,),
                                       trainable = True,
                                       initializer = initializer)
         self.phis = self.add_weight(name = 'phis',
-                                    dtype = tf.float64,
+                                    dtype = self.real_dtype,
                                     shape = (self.num_qubits,),
                                     trainable = True,
                                     initializer = initializer)
 
-        self.input_shifts = phase_shifts_to_tensor_product_space(self.alphas, self.betas).to_dense()
-        self.theta_shifts = phase_shifts_to_tensor_product_space(self.thetas, tf.zeros_like(self.thetas)).to_dense()
-        self.phi_shifts = phase_shifts_to_tensor_product_space(self.phis, tf.zeros_like(self.phis)).to_dense()
-
-        self.bs_matrix = tf.convert_to_tensor(tensors([BS_MATRIX] * self.num_qubits), dtype = tf.complex128)
+        # The beamsplitter operator is the N-fold tensor product of BS_MATRIX, so only the 2x2 factor is stored
+        self.bs = tf.constant(BS_MATRIX, dtype = self.complex_dtype)
+        self._mode_wise_eq = mode_wise_einsum_equation(self.num_qubits)
 
         # For TF 1.x
         super(SingleQubitOperationLayer, self).build(input_shape)
 
-    # @tf.function
-    # def get_hilbert_space_matrices(self):
-    #     input_shifts = phase_shifts_to_tensor_product_space(self.alphas, self.betas).to_dense()
-    #     theta_shifts = phase_shifts_to_tensor_product_space(self.thetas, tf.zeros_like(self.thetas)).to_dense()
-    #     phi_shifts = phase_shifts_to_tensor_product_space(self.phis, tf.zeros_like(self.phis)).to_dense()
-    #     bs_matrix = tf.convert_to_tensor(tensors([BS_MATRIX] * self.num_qubits), dtype = tf.complex128)
-    #     return input_shifts, theta_shifts, phi_shifts, bs_matrix
+    def get_unitaries(self):
+        '''
+        Returns the [N, 2, 2] operators the layer applies to each qubit. The phase shifts and beamsplitters fuse into
+        one 2x2 operator per qubit, applied in a single contraction. These are recomputed from the current weights on
+        each call rather than stored, which only costs O(N) small ops.
+        '''
+        return single_qubit_unitaries(self.alphas, self.betas, self.thetas, self.phis, self.bs)
+
+    def dense_bs_matrix(self):
+        '''
+        Materializes the 2^N x 2^N beamsplitter operator, which is never formed otherwise. The equivalence tests use it
+        as the dense baseline for the layer and for the Numba beamsplitter kernel.
+        '''
+        return tf.convert_to_tensor(tensors([BS_MATRIX] * self.num_qubits), dtype = self.complex_dtype)
 
     def call(self, x, **kwargs):
-        out = x
+        if self.use_custatevec:
+            return custatevec.tf_apply_single_qubit_layer(x, self.get_unitaries())
+        return self._call_fn(x)
 
-        # The @tf.function decorator means that these tensor products are only computed once, so this isn't expensive
-        # input_shifts, theta_shifts, phi_shifts, bs_matrix = self.get_hilbert_space_matrices()
+    def apply_unitaries(self, x):
+        out = x if self.tensorized else tf.reshape(x, [-1] + get_state_shape(self.num_qubits, tensorized = True))
 
-        out = dot(out, self.input_shifts)
-        out = dot(out, self.bs_matrix)
-        out = dot(out, self.theta_shifts)
-        out = dot(out, self.bs_matrix)
-        out = dot(out, self.phi_shifts)
+        if self.contraction == 'matmul':
+            out = apply_single_qubit_ops_matmul(out, tf.unstack(self.get_unitaries()))
+        else:
+            out = tf.einsum(self._mode_wise_eq, out, *tf.unstack(self.get_unitaries()))
+
+        return out if self.tensorized else tf.reshape(out, [-1, self.output_dim])
+
+    def call_real(self, x):
+        '''
+        Applies the layer using only real arithmetic to a [batch, 2, ...] state holding its real and imaginary parts on
+        axis 1. Each qubit's operator acts on both parts at once as a real block operator, so a layer is still a single
+        contraction per qubit.
+        '''
+        out = x if self.tensorized else tf.reshape(x, [-1, 2] + get_state_shape(self.num_qubits, tensorized = True))
+
+        ops = tf.unstack(real_block_operators(self.get_unitaries()))
+        if self.contraction == 'matmul':
+            for q, op in enumerate(ops):
+                out = apply_real_single_qubit_op_matmul(out, op, q, self.num_qubits)
+        else:
+            out = tf.einsum(real_mode_wise_einsum_equation(self.num_qubits), out, *ops)
 
-        return out
+        return out if self.tensorized else tf.reshape(out, [-1, 2, self.output_dim])
 
     def compute_output_shape(self, input_shape):
         return input_shape
@@ -102,13 +263,23 @@ class SingleQubitOperationLayer(Layer):
 
 class CPhaseLayer(Layer):
 
-    def __init__(self, num_qubits, parity = 0, use_standard_cphase = False, **kwargs):
+    def __init__(self, num_qubits, parity = 0, use_standard_cphase = False, complex_dtype = DTYPE_C, tensorized = False,
+                 transfer_diag = None, **kwargs):
         self.num_qubits = num_qubits
         self.parity = parity
         self.use_standard_cphase = use_standard_cphase
         self.output_dim = 2 ** num_qubits
+        self.complex_dtype = tf.as_dtype(complex_dtype)
+        # If tensorized, inputs and outputs have shape [batch, 2, ..., 2] rather than [batch, 2^N]
+        self.tensorized = tensorized
+        # Optional precomputed diagonal (see cphase_transfer_diag_tensor), which can be shared between layers
+        self.shared_transfer_diag = transfer_diag
         super(CPhaseLayer, self).__init__(**kwargs)
 
+        state_shape = get_state_shape(self.num_qubits, self.tensorized)
+        input_signature = [tf.TensorSpec([None] + state_shape, self.complex_dtype)]
+        self._call_fn = tf.function(self.apply_transfer_diag, input_signature = input_signature, jit_compile = True)
+
     def get_config(self):
         config = super(CPhaseLayer, self).get_config()
         config.update({
@@ -116,40 +287,44 @@ class CPhaseLayer(Layer):
             # 'output_dim'         : self.output_dim,
             'parity'             : self.parity,
             'use_standard_cphase': self.use_standard_cphase,
+            'complex_dtype'      : self.complex_dtype.name,
+            'tensorized'         : self.tensorized,
         })
         return config
 
     def get_cphase_gate(self):
         return CPHASE if self.use_standard_cphase else CPHASE_MOD
 
+    @property
+    def transfer_diag_np(self):
+        '''The flattened transfer matrix diagonal as a numpy array'''
+        return np.reshape(keras.backend.get_value(self.transfer_diag), [-1])
+
     def build(self, input_shape):
-        input_dim = input_shape[-1]
-        assert input_dim == self.output_dim
-
-        ops = []
-        if self.parity == 0:
-            num_cphase = self.num_qubits // 2
-            for _ in range(num_cphase):
-                ops.append(self.get_cphase_gate())
-            if 2 * num_cphase < self.num_qubits:
-                ops.append(IDENTITY)
-        else:
-            ops.append(IDENTITY)
-            num_cphase = (self.num_qubits - 1) // 2
-            for _ in range(num_cphase):
-                ops.append(self.get_cphase_gate())
-            if 2 * num_cphase + 1 < self.num_qubits:
-                ops.append(IDENTITY)
+        assert tf.TensorShape(input_shape).as_list()[1:] == get_state_shape(self.num_qubits, self.tensorized)
 
-        self.transfer_matrix_np = tensors(ops)
-        self.transfer_matrix = tf.convert_to_tensor(self.transfer_matrix_np, dtype = tf.complex128)
+        if self.shared_transfer_diag is not None:
+            self.transfer_diag = self.shared_transfer_diag
+        else:
+            self.transfer_diag = cphase_transfer_diag_tensor(self.num_qubits,
+                                                             parity = self.parity,
+                                                             use_standard_cphase = self.use_standard_cphase,
+                                                             complex_dtype = self.complex_dtype,
+                                                             tensorized = self.tensorized)
 
         # For TF 1.x
         super(CPhaseLayer, self).build(input_shape)
 
-    # @tf.function
     def call(self, x, **kwargs):
-        return dot(x, self.transfer_matrix)
+        return self._call_fn(x)
+
+    def apply_transfer_diag(self, x):
+        return x * self.transfer_diag
+
+    def call_real(self, x):
+        '''Applies the layer to a [batch, 2, ...] state holding its real and imaginary parts on axis 1'''
+        # CPHASE diagonals are +/-1, so only the real part is needed, and it broadcasts over both parts
+        return x * tf.math.real(self.transfer_diag)
 
     def compute_output_shape(self, input_shape):
         return input_shape
@@ -160,8 +335,13 @@ class QPGA(keras.Model):
     def __init__(self, num_qubits, depth,
                  complex_inputs = False,
                  complex_outputs = False,
-                 use_standard_cphase = True):
-        super(QPGA, self).__init__(name = 'qpga')
+                 use_standard_cphase = True,
+                 dtype = DTYPE_C,
+                 use_custatevec = False,
+                 use_real_kernels = False,
+                 contraction = 'einsum'):
+        # Real inputs are autocast to the model's compute dtype, so that is set to match the model's precision
+        super(QPGA, self).__init__(name = 'qpga', dtype = tf.as_dtype(dtype).real_dtype.name)
 
         self.num_qubits = num_qubits
         self.input_dim = 2 ** num_qubits
@@ -170,50 +350,186 @@ class QPGA(keras.Model):
         self.complex_inputs = complex_inputs
         self.complex_outputs = complex_outputs
         self.use_standard_cphase = use_standard_cphase
-
-        self.input_layer = SingleQubitOperationLayer(self.num_qubits)
+        self.complex_dtype = tf.as_dtype(dtype)
+        self.real_dtype = self.complex_dtype.real_dtype
+        self.use_custatevec = use_custatevec and custatevec.is_available()
+        # Propagate the real and imaginary parts of the state separately rather than as a complex tensor
+        self.use_real_kernels = use_real_kernels
+        self.contraction = contraction
+
+        # Only two distinct CPHASE layers exist, so their diagonals are built once and shared by all layers of a parity
+        self._cphase_diag_even, self._cphase_diag_odd = [
+            cphase_transfer_diag_tensor(self.num_qubits,
+                                        parity = parity,
+                                        use_standard_cphase = self.use_standard_cphase,
+                                        complex_dtype = self.complex_dtype,
+                                        tensorized = True)
+            for parity in (0, 1)]
+
+        # The layers operate on the state in its [batch, 2, ..., 2] form, which is only reshaped at the model boundaries
+        self.input_layer = SingleQubitOperationLayer(self.num_qubits,
+                                                     complex_dtype = self.complex_dtype,
+                                                     tensorized = True,
+                                                     use_custatevec = self.use_custatevec,
+                                                     contraction = self.contraction)
         self.single_qubit_layers = []
         self.cphase_layers = []
         for i in range(depth):
+            transfer_diag = self._cphase_diag_odd if i % 2 else self._cphase_diag_even
             self.cphase_layers.append(CPhaseLayer(self.num_qubits,
                                                   parity = i % 2,
-                                                  use_standard_cphase = self.use_standard_cphase))
-            self.single_qubit_layers.append(SingleQubitOperationLayer(self.num_qubits))
+                                                  use_standard_cphase = self.use_standard_cphase,
+                                                  complex_dtype = self.complex_dtype,
+                                                  tensorized = True,
+                                                  transfer_diag = transfer_diag))
+            self.single_qubit_layers.append(SingleQubitOperationLayer(self.num_qubits,
+                                                                      complex_dtype = self.complex_dtype,
+                                                                      tensorized = True,
+                                                                      use_custatevec = self.use_custatevec,
+                                                                      contraction = self.contraction))
+
+        # Compiling the whole model lets XLA fuse operations across layers of the circuit. Inputs are cast to the model
+        # precision before reaching the compiled function so that they always match its static input signature.
+        if not self.complex_inputs:
+            input_signature = [tf.TensorSpec([None, 2, self.input_dim], self.real_dtype)]
+        else:
+            input_signature = [tf.TensorSpec([None, self.input_dim], self.complex_dtype)]
+        self._call_fn = tf.function(self.forward, input_signature = input_signature, jit_compile = True)
 
     def as_sequential(self):
-        '''Converts the QPGA instance into a sequential model for easier inspection'''
+        '''
+        Converts the QPGA instance into a sequential model for easier inspection. The layers keep their contraction
+        setting, but a sequential model passes a single complex tensor between layers, so it can't use the real kernels.
+        '''
+        if self.use_real_kernels:
+            raise ValueError("as_sequential does not support use_real_kernels; call the QPGA model directly instead")
         model = Sequential()
         model.num_qubits = self.num_qubits
         model.complex_inputs = self.complex_inputs
         if not self.complex_inputs:
-            model.add(Input(shape = (2, self.input_dim,), dtype = 'float64'))
-            model.add(Lambda(lambda x: k_to_tf_complex(x), output_shape = (self.input_dim,)))
+            model.add(Input(shape = (2, self.input_dim,), dtype = self.real_dtype.name))
+            model.add(Lambda(lambda x: k_to_tf_complex(x),
+                             output_shape = (self.input_dim,),
+                             dtype = self.real_dtype.name))
         else:
-            model.add(Input(shape = (self.input_dim,), dtype = 'complex128'))
+            model.add(Input(shape = (self.input_dim,), dtype = self.complex_dtype.name))
+        model.add(Lambda(lambda x: tf.reshape(x, [-1] + get_state_shape(self.num_qubits, tensorized = True))))
 
         model.add(self.input_layer)
         for cphase_layer, single_qubit_layer in zip(self.cphase_layers, self.single_qubit_layers):
             model.add(cphase_layer)
             model.add(single_qubit_layer)
 
+        model.add(Lambda(lambda x: tf.reshape(x, [-1, self.input_dim])))
         model.complex_outputs = self.complex_outputs
         if not self.complex_outputs:
             model.add(Lambda(lambda x: tf_to_k_complex(x)))
 
         return model
 
-    # @tf.function
     def call(self, inputs):
+        # forward_real calls the layers without going through Keras, so they have to be built before it is traced
+        if self.use_real_kernels:
+            self.build_layers()
+        # The cuStateVec path runs outside of TensorFlow, so it can't be compiled with XLA
+        if self.use_custatevec:
+            return self.forward(inputs)
+        return self._call_fn(tf.cast(inputs, self.complex_dtype if self.complex_inputs else self.real_dtype))
+
+    def finalize_for_inference(self):
+        '''
+        Specializes the forward pass to this model's num_qubits and depth by generating straight-line code for it, with
+        no Python loops or layer calls, which is compiled with XLA. The current weights are frozen into the generated
+        function as constants, so it maps inputs to outputs like the model itself and takes no other arguments. The
+        generated code is kept in inference_source.
+        '''
+        self.build_layers()
+        state_shape = [-1] + get_state_shape(self.num_qubits, tensorized = True)
+        eq = mode_wise_einsum_equation(self.num_qubits)
+
+        # Flat list of the 2x2 operators of every single qubit layer, followed by the two CPHASE diagonals. These are
+        # held as numpy arrays, which become constants of the graph when the generated function is traced.
+        weights = []
+        for layer in [self.input_layer] + self.single_qubit_layers:
+            weights.extend(keras.backend.get_value(layer.get_unitaries()))
+        weights.extend(keras.backend.get_value(diag) for diag in (self._cphase_diag_even, self._cphase_diag_odd))
+        cphase_slots = [len(weights) - 2, len(weights) - 1]
+
+        def apply_single_qubit_layer(i):
+            slots = range(i * self.num_qubits, (i + 1) * self.num_qubits)
+            return f"    x = tf.einsum('{eq}', x, {', '.join(f'w[{slot}]' for slot in slots)})"
+
+        lines = ["def fwd(x):"]
+        if not self.complex_inputs:
+            lines.append(f"    x = tf.cast(x, tf.{self.real_dtype.name})")
+            lines.append("    x = tf.complex(x[:, 0, :], x[:, 1, :])")
+        else:
+            lines.append(f"    x = tf.cast(x, tf.{self.complex_dtype.name})")
+        lines.append(f"    x = tf.reshape(x, {state_shape})")
+        lines.append(apply_single_qubit_layer(0))
+        for i in range(self.depth):
+            lines.append(f"    x = x * w[{cphase_slots[i % 2]}]")
+            lines.append(apply_single_qubit_layer(i + 1))
+        lines.append(f"    x = tf.reshape(x, [-1, {self.input_dim}])")
+        if not self.complex_outputs:
+            lines.append("    x = tf.stack([tf.math.real(x), tf.math.imag(x)], axis = 1)")
+        lines.append("    return x")
+
+        self.inference_source = "\n".join(lines)
+        namespace = {'tf': tf, 'w': weights}
+        exec(self.inference_source, namespace)
+
+        return tf.function(namespace['fwd'], jit_compile = True)
+
+    def build_layers(self):
+        '''
+        Builds the layers directly, since forward_real bypasses the automatic build on the first layer call. Like that
+        automatic build, this lifts out of any function being traced, so that the weights and constants of the layers
+        are created eagerly rather than captured by a single trace.
+        '''
+        input_shape = tf.TensorShape([None] + get_state_shape(self.num_qubits, tensorized = True))
+        with tf.init_scope():
+            for layer in [self.input_layer] + self.cphase_layers + self.single_qubit_layers:
+                if not layer.built:
+                    layer.build(input_shape)
+
+    def forward_real(self, inputs):
+        # Real inputs already hold the real and imaginary parts on axis 1, which is the layout of the real kernels
+        if not self.complex_inputs:
+            x = tf.cast(inputs, self.real_dtype)
+        else:
+            x = tf.cast(inputs, self.complex_dtype)
+            x = tf.stack([tf.math.real(x), tf.math.imag(x)], axis = 1)
+        x = tf.reshape(x, [-1, 2] + get_state_shape(self.num_qubits, tensorized = True))
+
+        x = self.input_layer.call_real(x)
+        for cphase_layer, single_qubit_layer in zip(self.cphase_layers, self.single_qubit_layers):
+            x = cphase_layer.call_real(x)
+            x = single_qubit_layer.call_real(x)
+
+        x = tf.reshape(x, [-1, 2, self.input_dim])
+        if not self.complex_outputs:
+            return x
+        return tf.complex(x[:, 0, :], x[:, 1, :])
+
+    def forward(self, inputs):
+        if self.use_real_kernels:
+            return self.forward_real(inputs)
+
         x = inputs
 
         if not self.complex_inputs:
-            x = k_to_tf_complex(x)
+            x = k_to_tf_complex(tf.cast(x, self.real_dtype))
+        else:
+            x = tf.cast(x, self.complex_dtype)
+        x = tf.reshape(x, [-1] + get_state_shape(self.num_qubits, tensorized = True))
 
         x = self.input_layer(x)
         for cphase_layer, single_qubit_layer in zip(self.cphase_layers, self.single_qubit_layers):
             x = cphase_layer(x)
             x = single_qubit_layer(x)
 
+        x = tf.reshape(x, [-1, self.input_dim])
         if not self.complex_outputs:
             x = tf_to_k_complex(x)
 
@@ -221,14 +537,12 @@ class QPGA(keras.Model):
 
 
 def antifidelity(state_true, state_pred):
-    # inner_prods = tf.einsum('bs,bs->b', tf.math.conj(state_true), state_pred)
-    print(state_true.shape)
-    print(state_pred.shape)
-    state_true = k_to_tf_complex(state_true)
-    state_pred = k_to_tf_complex(state_pred)
-    inner_prods = tf.reduce_sum(tf.multiply(tf.math.conj(state_true), state_pred), 1)
-    amplitudes = tf.abs(inner_prods)
-    return tf.ones_like(amplitudes) - amplitudes ** 2
+    # Targets may be supplied in double precision while the model runs in single precision
+    state_true = tf.cast(state_true, state_pred.dtype)
+    state_true = tf.complex(state_true[..., 0, :], state_true[..., 1, :])
+    state_pred = tf.complex(state_pred[..., 0, :], state_pred[..., 1, :])
+    inner_prods = tf.einsum('bs,bs->b', tf.math.conj(state_true), state_pred)
+    return 1.0 - tf.square(tf.abs(inner_prods))
 
 
 def load_model(filename):
@@ -9,11 +9,10 @@ from qpga.utils import *
 from qpga.fidelity_search import *
 
 # dynamically grow GPU memory to prevent tf from just claiming all of it at once
-config = tf.ConfigProto()
-config.gpu_options.allow_growth = True
-K.set_session(tf.Session(config = config))
+for gpu in tf.config.list_physical_devices('GPU'):
+    tf.config.experimental.set_memory_growth(gpu, True)
 
-DEFAULT_BATCH_SIZE = 64 if tf.test.is_gpu_available() else 32
+DEFAULT_BATCH_SIZE = 64 if tf.config.list_physical_devices('GPU') else 32
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = "Run a fidelity search on QPGA with specified number of qubits")
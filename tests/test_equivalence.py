@@ -0,0 +1,161 @@
+'''
+Checks that every implementation of the QPGA forward pass agrees: the default mode-wise einsum path against dense
+matrices built with tensors(), and each alternative path against the default one. Paths whose optional dependencies
+or hardware are missing are skipped.
+'''
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("squanch")
+
+from qpga.backends import custatevec
+from qpga.constants import BS_MATRIX, CPHASE, IDENTITY
+from qpga.linalg import tensors
+from qpga.model import QPGA, SingleQubitOperationLayer, CPhaseLayer
+
+NUM_QUBITS = 4
+DEPTH = 3
+BATCH_SIZE = 5
+TOL = 1e-9
+
+requires_custatevec = pytest.mark.skipif(not custatevec.is_available(), reason = "cuStateVec is not available")
+
+
+def random_states(num_qubits, batch_size = BATCH_SIZE, seed = 0):
+    '''Returns a [batch_size, 2^num_qubits] batch of normalized random complex states'''
+    rng = np.random.default_rng(seed)
+    shape = (batch_size, 2 ** num_qubits)
+    states = rng.normal(size = shape) + 1j * rng.normal(size = shape)
+    return states / np.linalg.norm(states, axis = 1, keepdims = True)
+
+
+def dense_layer_operator(layer):
+    '''Builds the 2^N x 2^N operator of a built SingleQubitOperationLayer as a product of dense matrices'''
+    alphas, betas, thetas, phis = layer.get_weights()
+
+    def phase_shifts(phi_0, phi_1):
+        return np.diag(tensors([np.exp(1j * np.array([p0, p1])) for p0, p1 in zip(phi_0, phi_1)]))
+
+    bs = layer.dense_bs_matrix().numpy()
+    zeros = np.zeros_like(thetas)
+    return phase_shifts(alphas, betas) @ bs @ phase_shifts(thetas, zeros) @ bs @ phase_shifts(phis, zeros)
+
+
+def make_layer(**kwargs):
+    '''Creates a built double precision SingleQubitOperationLayer on flat states'''
+    layer = SingleQubitOperationLayer(NUM_QUBITS, complex_dtype = tf.complex128, **kwargs)
+    layer.build(tf.TensorShape([None, 2 ** NUM_QUBITS]))
+    return layer
+
+
+def copy_layer(layer, **kwargs):
+    '''Creates a SingleQubitOperationLayer with the weights of layer but other settings'''
+    other = make_layer(**kwargs)
+    other.set_weights(layer.get_weights())
+    return other
+
+
+def make_model(**kwargs):
+    '''Creates a built double precision QPGA on complex states'''
+    model = QPGA(NUM_QUBITS, DEPTH, complex_inputs = True, complex_outputs = True, dtype = tf.complex128, **kwargs)
+    model(tf.constant(random_states(NUM_QUBITS, batch_size = 1)))
+    return model
+
+
+def copy_model(model, **kwargs):
+    '''Creates a QPGA with the weights of model but other settings'''
+    other = make_model(**kwargs)
+    other.set_weights(model.get_weights())
+    return other
+
+
+def test_single_qubit_layer_matches_dense_operator():
+    layer = make_layer()
+    states = random_states(NUM_QUBITS)
+    np.testing.assert_allclose(layer(tf.constant(states)).numpy(), states @ dense_layer_operator(layer), atol = TOL)
+
+
+@pytest.mark.parametrize("parity", [0, 1])
+def test_cphase_layer_matches_dense_operator(parity):
+    layer = CPhaseLayer(NUM_QUBITS, parity = parity, use_standard_cphase = True, complex_dtype = tf.complex128)
+    # Even layers pair qubits (0, 1) and (2, 3), odd layers pair qubits (1, 2)
+    gates = [CPHASE, CPHASE] if parity == 0 else [IDENTITY, CPHASE, IDENTITY]
+    states = random_states(NUM_QUBITS)
+    np.testing.assert_allclose(layer(tf.constant(states)).numpy(), states @ tensors(gates), atol = TOL)
+
+
+def test_single_qubit_layer_matmul_matches_einsum():
+    layer = make_layer()
+    states = tf.constant(random_states(NUM_QUBITS))
+    other = copy_layer(layer, contraction = 'matmul')
+    np.testing.assert_allclose(other(states).numpy(), layer(states).numpy(), atol = TOL)
+
+
+@pytest.mark.parametrize("contraction", ['einsum', 'matmul'])
+def test_single_qubit_layer_real_matches_complex(contraction):
+    layer = make_layer()
+    states = tf.constant(random_states(NUM_QUBITS))
+    other = copy_layer(layer, contraction = contraction)
+    out = other.call_real(tf.stack([tf.math.real(states), tf.math.imag(states)], axis = 1))
+    np.testing.assert_allclose(tf.complex(out[:, 0], out[:, 1]).numpy(), layer(states).numpy(), atol = TOL)
+
+
+@requires_custatevec
+def test_single_qubit_layer_custatevec_matches_einsum():
+    layer = make_layer()
+    # A batch size with several set bits exercises the split of the batch into power of two runs
+    states = tf.constant(random_states(NUM_QUBITS, batch_size = 7))
+    other = copy_layer(layer, use_custatevec = True)
+    np.testing.assert_allclose(other(states).numpy(), layer(states).numpy(), atol = TOL)
+
+
+@pytest.mark.parametrize("kwargs", [dict(use_real_kernels = True),
+                                    dict(contraction = 'matmul'),
+                                    dict(use_real_kernels = True, contraction = 'matmul'),
+                                    pytest.param(dict(use_custatevec = True), marks = requires_custatevec)])
+def test_qpga_paths_match_einsum(kwargs):
+    model = make_model()
+    states = tf.constant(random_states(NUM_QUBITS))
+    other = copy_model(model, **kwargs)
+    # Calling twice checks that retracing the compiled forward pass reuses the same weights
+    for _ in range(2):
+        np.testing.assert_allclose(other(states).numpy(), model(states).numpy(), atol = TOL)
+
+
+def test_qpga_finalize_for_inference_matches_call():
+    model = make_model()
+    states = tf.constant(random_states(NUM_QUBITS))
+    np.testing.assert_allclose(model.finalize_for_inference()(states).numpy(), model(states).numpy(), atol = TOL)
+
+
+def test_numba_qpga_matches_einsum():
+    pytest.importorskip("numba")
+    from qpga.kernels_numba import NumbaQPGA
+
+    model = make_model()
+    states = random_states(NUM_QUBITS)
+    out = NumbaQPGA.from_keras(model).predict(states)
+    np.testing.assert_allclose(out, model(tf.constant(states)).numpy(), atol = TOL)
+
+
+def test_numba_bs_all_qubits_matches_dense_bs_matrix():
+    pytest.importorskip("numba")
+    from qpga.kernels_numba import apply_bs_all_qubits
+
+    layer = SingleQubitOperationLayer(NUM_QUBITS, complex_dtype = tf.complex128)
+    state = random_states(NUM_QUBITS, batch_size = 1)[0]
+    out = apply_bs_all_qubits(state.copy(), np.array(BS_MATRIX))
+    np.testing.assert_allclose(out, state @ layer.dense_bs_matrix().numpy(), atol = TOL)
+
+
+def test_jax_qpga_matches_einsum():
+    pytest.importorskip("jax")
+    from jax.experimental import enable_x64
+    from qpga.jax_model import params_from_keras, qpga_apply_batch
+
+    model = make_model()
+    states = random_states(NUM_QUBITS)
+    with enable_x64():
+        out = np.asarray(qpga_apply_batch(states, *params_from_keras(model)))
+    np.testing.assert_allclose(out, model(tf.constant(states)).numpy(), atol = TOL)